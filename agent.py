@@ -2,18 +2,22 @@
 
 import os
 from dotenv import load_dotenv
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 from datetime import datetime
 import logging # <-- NEW: Logging module
 
 # --- CORE LANGCHAIN IMPORTS ---
 from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.messages import BaseMessage, SystemMessage, HumanMessage
 from langchain_core.runnables import RunnablePassthrough
+from langchain_core.tools import StructuredTool
 from pydantic import BaseModel, Field
 
 # Import your custom modules
-from tools import get_daily_logs, calculate_metrics, save_user_plan, load_active_plan
+from tools import (
+    get_daily_logs, calculate_metrics, save_user_plan, load_active_plan,
+    get_daily_logs_async, calculate_metrics_async, save_user_plan_async, load_active_plan_async,
+)
 from models import HealthPlan # The structured output model
 
 # --- Logging Configuration ---
@@ -27,6 +31,7 @@ load_dotenv()
 LLM: ChatOpenAI = ChatOpenAI( # <-- NEW: Type Hint
     model="gpt-4o-mini",
     temperature=0,
+    streaming=True, # Emit tokens as they arrive so the UI can render the plan progressively
     api_key=os.getenv("OPENAI_API_KEY")
 )
 
@@ -44,11 +49,14 @@ USER_PROFILE: Dict[str, Any] = { # <-- NEW: Type Hint
 }
 
 # --- 3. Define the Tools Available to the LLM ---
-AGENT_TOOLS: List[Any] = [ # <-- NEW: Type Hint
-    calculate_metrics,
-    get_daily_logs,
-    save_user_plan,
-    load_active_plan,
+# Tool definitions (name, description, argument schema) for the agent's functions. They are not bound to
+# AGENT_CHAIN and nothing executes them yet; the graph nodes call the *_async variants from tools.py directly.
+# The coroutine is attached so a future async tool executor would offload the blocking call to a thread.
+AGENT_TOOLS: List[StructuredTool] = [ # <-- NEW: Type Hint
+    StructuredTool.from_function(func=calculate_metrics, coroutine=calculate_metrics_async),
+    StructuredTool.from_function(func=get_daily_logs, coroutine=get_daily_logs_async),
+    StructuredTool.from_function(func=save_user_plan, coroutine=save_user_plan_async),
+    StructuredTool.from_function(func=load_active_plan, coroutine=load_active_plan_async),
 ]
 
 # --- 4. The Core Planning Prompt (No Change) ---
@@ -56,37 +64,47 @@ SYSTEM_PROMPT = """
 ... (Prompt content unchanged) ...
 """
 
-PLANNING_PROMPT = ChatPromptTemplate.from_messages(
-    [
-        ("system", SYSTEM_PROMPT),
-        ("user", "Analyze the provided user profile, history, and metrics. Generate a comprehensive 7-day health and nutrition plan for the goal: {goal_description}. The current date is {current_date}."),
-    ]
+# The system prompt is static, so its message is built once; only the user message is rendered per call.
+SYSTEM_MSG = SystemMessage(content=SYSTEM_PROMPT)
+
+USER_PROMPT = "Analyze the provided user profile, history, and metrics. Generate a comprehensive 7-day health and nutrition plan for the goal: {goal_description}. The current date is {current_date}."
+
+def build_planning_messages(goal_description: str, current_date: str, llm_context: Optional[str] = None) -> List[BaseMessage]:
+    """Returns the planning prompt messages, appending the agent's context to the system prompt when given."""
+    system_msg = SYSTEM_MSG
+    if llm_context:
+        system_msg = SystemMessage(content=SYSTEM_PROMPT + f"\n\nCONTEXT AND HISTORY FOR ADAPTATION:\n{llm_context}")
+    
+    user_msg = HumanMessage(content=USER_PROMPT.format(goal_description=goal_description, current_date=current_date))
+    return [system_msg, user_msg]
+
+# --- 5. The Planning Chain (Built Once) ---
+# Built at import time and reused by every run. with_structured_output binds a single HealthPlan tool and
+# forces the model to call it; method="function_calling" keeps the plan in the tool-call arguments, which is
+# what run_agent_loop_stream parses while streaming (langchain-openai >= 0.3 defaults to "json_schema").
+AGENT_CHAIN = LLM.with_structured_output(
+    schema=HealthPlan, 
+    method="function_calling",
 )
 
-# --- 5. Initial Agent Setup and Testing ---
+# --- 6. Initial Agent Setup and Testing ---
 
 def run_initial_planning() -> None: # <-- NEW: Type Hint
     """Sets up and runs the initial chain for generating the first plan, with error handling."""
     logger.info("--- Starting Initial Planning Chain ---")
     
     try:
-        # 1. Bind tools to the LLM. 
-        agent_chain = LLM.bind_tools(
-            AGENT_TOOLS,
-            tool_choice={"type": "function", "function": {"name": "save_user_plan"}} 
-        ).with_structured_output(
-            schema=HealthPlan, 
-        )
+        # 1. Use the prebuilt chain (LLM bound to tools and structured output)
+        agent_chain = AGENT_CHAIN
         
-        # 2. Prepare the context for the prompt
-        context: Dict[str, str] = { # <-- NEW: Type Hint
-            "user_id": TEST_USER_ID,
-            "goal_description": USER_PROFILE["goal"],
-            "current_date": datetime.now().strftime("%Y-%m-%d")
-        }
+        # 2. Prepare the prompt messages
+        messages = build_planning_messages(
+            goal_description=USER_PROFILE["goal"],
+            current_date=datetime.now().strftime("%Y-%m-%d")
+        )
         
         # 3. Run the chain (CRITICAL API CALL)
-        result = agent_chain.invoke(PLANNING_PROMPT.format(**context))
+        result = agent_chain.invoke(messages)
         
         # 4. Log Success
         logger.info("Plan generation and saving successfully executed via LLM tool call.")
@@ -2,15 +2,16 @@
 
 import streamlit as st
 import pandas as pd
-from run_agent import run_agent_loop, TEST_USER_ID
+from run_agent import run_agent_loop_stream, TEST_USER_ID
 # UPDATE: Import the new history tool
-from tools import load_active_plan, generate_weight_history 
+from tools import load_active_plan, generate_weight_history, get_mongo_client, set_mongo_client
+from pymongo.mongo_client import MongoClient
 from agent import USER_PROFILE # Needed for chart data
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Iterator, TYPE_CHECKING
 
-# NEW: Plotly imports for visualization
-import plotly.graph_objects as go 
-import plotly.express as px 
+# Plotly is heavy to import, so it is loaded lazily by the chart builder (cold-start win)
+if TYPE_CHECKING:
+    import plotly.graph_objects as go
 
 
 # --- CACHED DATA LOADER FIX ---
@@ -24,20 +25,36 @@ def get_latest_plan_from_db(user_id):
 st.set_page_config(layout="wide")
 
 
+# --- Shared Database Connection ---
+@st.cache_resource(show_spinner="Connecting to database...")
+def get_db_client() -> MongoClient:
+    """Connects to MongoDB once per server process; the client is shared by all sessions and reruns."""
+    return get_mongo_client()
+
+# A failed connect is not cached and each attempt blocks for the server selection timeout,
+# so after one failure this session stops retrying on every rerun (reload the page to retry).
+if st.session_state.get('db_connect_error'):
+    st.error(f"Could not connect to the database: {st.session_state['db_connect_error']} Reload the page to retry.")
+else:
+    try:
+        # Re-registers the cached client if tools.py was re-imported and lost its module-level reference
+        set_mongo_client(get_db_client())
+    except Exception as e:
+        st.session_state['db_connect_error'] = str(e)
+        st.error(f"Could not connect to the database: {e}")
+
+
 # --- NEW: Chart Function ---
 
-def display_progress_chart(user_profile: Dict[str, Any]):
-    """Generates and displays a Plotly chart of synthetic weight progress."""
-    st.subheader("📈 Progress Tracker (Synthetic Data)")
-    
-    # Generate data using the new tool
-    history_list: List[Dict[str, Any]] = generate_weight_history(
-        user_profile['user_id'], 
-        user_profile['initial_weight_kg'], 
-        weeks=12
-    )
-    history_df = pd.DataFrame(history_list)
-    
+@st.cache_data(show_spinner=False)
+def _load_weight_history(user_id: str, initial_weight: float, weeks: int) -> pd.DataFrame:
+    """Generates the synthetic weight history. Cached on the primitive inputs so reruns reuse the same data."""
+    return generate_weight_history(user_id, initial_weight, weeks=weeks)
+
+def _build_progress_figure(history_df: pd.DataFrame, weeks: int) -> "go.Figure":
+    """Builds the weight progress figure (not cached: unpickling a Plotly figure costs more than building it)."""
+    import plotly.graph_objects as go
+
     # Create the Plotly figure
     fig = go.Figure()
 
@@ -54,17 +71,43 @@ def display_progress_chart(user_profile: Dict[str, Any]):
     ))
 
     fig.update_layout(
-        title='Weight Loss Progress Over 12 Weeks',
+        title=f'Weight Loss Progress Over {weeks} Weeks',
         xaxis_title='Date / Week',
         yaxis_title='Weight (kg)',
         hovermode="x unified"
     )
 
+    return fig
+
+def display_progress_chart(user_profile: Dict[str, Any]):
+    """Displays a Plotly chart of synthetic weight progress."""
+    st.subheader("📈 Progress Tracker (Synthetic Data)")
+    
+    weeks = 12
+    history_df = _load_weight_history(user_profile['user_id'], user_profile['initial_weight_kg'], weeks)
+    fig = _build_progress_figure(history_df, weeks)
     st.plotly_chart(fig, use_container_width=True)
 
 # --- END NEW CHART FUNCTION ---
 
 
+# --- Streaming Helper for the Agent Run ---
+def stream_agent_rationale(user_id: str, final_state: Dict[str, Any]) -> Iterator[str]:
+    """
+    Runs the streaming agent loop and yields the agent's rationale as it is generated.
+    The latest state is kept in `final_state` so the caller can read the outcome afterwards.
+    """
+    streamed = ""
+    for state in run_agent_loop_stream(user_id):
+        final_state.clear()
+        final_state.update(state)
+        
+        reasoning = (state.get('partial_plan') or {}).get('agent_reasoning')
+        if isinstance(reasoning, str) and len(reasoning) > len(streamed):
+            yield reasoning[len(streamed):]
+            streamed = reasoning
+
+
 # --- Helper Function to Display Plan (Slightly modified with type hint) ---
 def display_plan(plan_data: Dict[str, Any]):
     # Note: plan_data is a clean dictionary fetched from MongoDB
@@ -87,6 +130,25 @@ def display_plan(plan_data: Dict[str, Any]):
 
     day_tabs = st.tabs([f"Day {i+1}" for i in range(len(clean_daily_plans))])
 
+    # Build the meals table for all days at once, column by column, indexed by day; one groupby splits it per tab
+    days: List[int] = []
+    meal_types: List[Optional[str]] = []
+    suggestions: List[Optional[str]] = []
+    kcals: List[Optional[int]] = []
+    for i, day_plan in enumerate(clean_daily_plans):
+        for meal in day_plan.get('meals', []):
+            days.append(i)
+            meal_types.append(meal.get('meal_type'))
+            suggestions.append(meal.get('recipe_suggestion'))
+            kcals.append(meal.get('estimated_kcal'))
+
+    meals_df = pd.DataFrame({
+        "Type": meal_types,
+        "Suggestion": suggestions,
+        "Calories (est.)": kcals
+    }, index=days)
+    meals_by_day: Dict[int, pd.DataFrame] = dict(list(meals_df.groupby(level=0)))
+
     for i, day_plan in enumerate(clean_daily_plans):
         with day_tabs[i]:
             activity = day_plan.get('activity', {})
@@ -100,15 +162,8 @@ def display_plan(plan_data: Dict[str, Any]):
             st.subheader("🍽️ Meals")
             
             # Meals Table Display
-            meals_df = pd.DataFrame([
-                {
-                    "Type": meal.get('meal_type'),
-                    "Suggestion": meal.get('recipe_suggestion'),
-                    "Calories (est.)": meal.get('estimated_kcal')
-                }
-                for meal in day_plan.get('meals', [])
-            ])
-            st.dataframe(meals_df, use_container_width=True, hide_index=True)
+            day_meals_df = meals_by_day.get(i, meals_df.iloc[0:0]) # Empty frame for a day without meals
+            st.dataframe(day_meals_df, use_container_width=True, hide_index=True)
 
 
 # --- Streamlit Application Main Logic ---
@@ -126,7 +181,9 @@ with st.sidebar:
     if st.button("▶️ Run Adaptive Agent Loop", type="primary"):
         st.info("Running agent loop... Please wait. This may take 30-60 seconds.")
         
-        final_state = run_agent_loop(TEST_USER_ID)
+        # Stream the rationale of a new plan while the agent is still generating it
+        final_state: Dict[str, Any] = {}
+        st.write_stream(stream_agent_rationale(TEST_USER_ID, final_state))
         
         # 1. Clear the cache related to the plan data, forcing a fresh DB pull
         get_latest_plan_from_db.clear() 
@@ -141,6 +198,7 @@ with st.sidebar:
     # Optional: Button to clear memory for a fresh start 
     if st.button("⚠️ Clear All Plans (Reset DB)"):
         st.warning("Database reset initiated. Refresh page to see empty state.") 
+        _load_weight_history.clear()
         if 'plan_data' in st.session_state:
             del st.session_state['plan_data']
         st.rerun()
@@ -1,21 +1,22 @@
 # run_agent.py - LangGraph Implementation for Adaptive Planning Agent (POLISHED & STABILIZED)
 
-from typing import TypedDict, Optional, Dict, List, Any
+from typing import TypedDict, Optional, Dict, List, Any, Iterator, AsyncIterator
 from langgraph.graph import StateGraph, END
 import os
+import asyncio
+import threading
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
 import logging # <-- NEW: Logging module
 
 # CORE LANGCHAIN IMPORTS
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import SystemMessage, HumanMessage
+from langchain_core.utils.json import parse_partial_json
 
 # Import components from other files (ensure all are updated with logging/handling!)
-from tools import get_daily_logs, calculate_metrics, save_user_plan, load_active_plan
+from tools import calculate_metrics
+from tools import get_daily_logs_async, load_active_plan_async, save_user_plan_async
 from models import HealthPlan
-from agent import LLM, AGENT_TOOLS, PLANNING_PROMPT, TEST_USER_ID, USER_PROFILE 
+from agent import AGENT_CHAIN, build_planning_messages, TEST_USER_ID, USER_PROFILE
 
 # --- Logging Configuration ---
 # NOTE: This configuration needs to be executed once, often done in tools.py, but we'll ensure it's here too.
@@ -34,6 +35,7 @@ load_dotenv()
 class AgentState(TypedDict):
     """Represents the state of the agent's current task. (Includes Type Hints)"""
     user_id: str
+    current_date: str # Fixed once per run so every node sees the same date
     current_plan: Optional[Dict[str, Any]]
     progress_report: Optional[str]
     logs_data: Optional[Dict[str, Any]]
@@ -43,17 +45,19 @@ class AgentState(TypedDict):
 
 # --- 2. Define the Graph Nodes (The Agent's Actions) ---
 
-def fetch_data_node(state: AgentState) -> AgentState:
-    """Node 1: Fetches the current plan and today's logs, with error handling."""
+async def fetch_data_node(state: AgentState) -> AgentState:
+    """Node 1: Fetches the current plan and today's logs concurrently, with error handling."""
     logger.info("--- [Node: Fetch Data] ---")
     user_id = state['user_id']
     
     try:
-        active_plan = load_active_plan(user_id)
+        # The two lookups are independent: run the blocking calls in worker threads at the same time
+        today_date = state['current_date']
+        active_plan, logs = await asyncio.gather(
+            load_active_plan_async(user_id),
+            get_daily_logs_async(user_id, today_date)
+        )
         state['current_plan'] = active_plan
-
-        today_date = datetime.now().strftime("%Y-%m-%d")
-        logs = get_daily_logs(user_id, today_date)
         state['logs_data'] = logs
         
         state['llm_context'] = (
@@ -75,7 +79,7 @@ def fetch_data_node(state: AgentState) -> AgentState:
         
     return state
 
-def evaluate_progress_node(state: AgentState) -> AgentState:
+async def evaluate_progress_node(state: AgentState) -> AgentState:
     """Node 2: Evaluates compliance and progress to determine if replanning is needed."""
     logger.info("--- [Node: Evaluate Progress] ---")
     
@@ -91,7 +95,7 @@ def evaluate_progress_node(state: AgentState) -> AgentState:
         replan = True
     else:
         try:
-            # Get reliable calorie target for evaluation
+            # Get reliable calorie target for evaluation (pure and memoized, so no need to offload it)
             metrics = calculate_metrics(
                 weight_kg=logs['weight_kg'], 
                 height_cm=USER_PROFILE['height_cm'], 
@@ -120,44 +124,30 @@ def evaluate_progress_node(state: AgentState) -> AgentState:
     
     return state
 
-def planning_agent_node(state: AgentState) -> AgentState:
+async def planning_agent_node(state: AgentState) -> AgentState:
     """Node 3: The core LLM action to generate a new plan and save it, with robust error handling."""
     logger.info("--- [Node: Planning Agent] ---")
     logger.info(f"Reasoning for new plan: {state['progress_report']}")
     
     try:
-        # 1. Bind the LLM to the tools and the required output structure
-        agent_chain = LLM.bind_tools(
-            AGENT_TOOLS,
-            tool_choice={"type": "function", "function": {"name": "save_user_plan"}} 
-        ).with_structured_output(
-            schema=HealthPlan, 
-        )
-        
-        # 2. Prepare the base context
-        context = {
-            "user_id": state['user_id'],
-            "goal_description": USER_PROFILE["goal"],
-            "current_date": datetime.now().strftime("%Y-%m-%d")
-        }
-        
-        # 3. Augment the prompt safely
-        rendered_messages = PLANNING_PROMPT.format_messages(**context)
-        base_system_content = rendered_messages[0].content
-        user_message_content = rendered_messages[1].content
+        # 1. Use the prebuilt chain (LLM bound to the tools and the required output structure)
+        agent_chain = AGENT_CHAIN
         
-        augmented_system_content = (
-            base_system_content + 
-            f"\n\nCONTEXT AND HISTORY FOR ADAPTATION:\n{state['llm_context']}"
+        # 2. Prepare the prompt, augmented with the fetched data and the evaluation
+        augmented_messages = build_planning_messages(
+            goal_description=USER_PROFILE["goal"],
+            current_date=state['current_date'],
+            llm_context=state['llm_context']
         )
 
-        augmented_messages = [
-            SystemMessage(content=augmented_system_content),
-            HumanMessage(content=user_message_content)
-        ]
+        # 3. Stream the chain with the augmented messages list (LLM API Call)
+        # Each chunk is the plan parsed so far; the last one is the complete plan.
+        result = None
+        async for partial_plan in agent_chain.astream(augmented_messages):
+            result = partial_plan
 
-        # 4. Run the chain with the augmented messages list (LLM API Call)
-        result = agent_chain.invoke(augmented_messages)
+        if result is None:
+            raise ValueError("LLM stream ended without producing a plan.")
         
         logger.info("Plan generated successfully by LLM.")
         
@@ -170,7 +160,7 @@ def planning_agent_node(state: AgentState) -> AgentState:
             plan_dict = dict(result)
 
         # Save to MongoDB (uses the save_user_plan tool)
-        save_result = save_user_plan(state['user_id'], plan_dict)
+        save_result = await save_user_plan_async(state['user_id'], plan_dict)
         logger.info(f"✅ Database Save Result: {save_result}")
         # === END FIX ===
 
@@ -189,10 +179,8 @@ def planning_agent_node(state: AgentState) -> AgentState:
 
 # --- 3. Define the LangGraph Structure (The State Machine) ---
 
-def run_agent_loop(user_id: str):
-    """Initializes and runs the LangGraph agent loop."""
-    logger.info("\n\n--- Initializing LangGraph Agent Loop ---")
-    
+def build_agent_graph():
+    """Builds and compiles the LangGraph state machine for the agent loop."""
     workflow = StateGraph(AgentState)
     
     workflow.add_node("fetch_data", fetch_data_node)
@@ -215,10 +203,13 @@ def run_agent_loop(user_id: str):
     
     workflow.add_edge("planning_agent", END)
 
-    app = workflow.compile()
-    
-    initial_state = {
+    return workflow.compile()
+
+def _initial_state(user_id: str) -> AgentState:
+    """Returns the empty state every agent run starts from."""
+    return {
         "user_id": user_id,
+        "current_date": datetime.now().strftime("%Y-%m-%d"),
         "replan_needed": False,
         "current_plan": None,
         "progress_report": None,
@@ -226,18 +217,139 @@ def run_agent_loop(user_id: str):
         "plan_data": None,
         "llm_context": ""
     }
-    
-    final_state = app.invoke(initial_state)
-    
+
+def _log_outcome(final_state: AgentState) -> None:
+    """Logs the outcome of a finished agent run."""
     logger.info("--- Agent Loop Finished ---")
     logger.info(f"Final Outcome: {final_state['progress_report']}")
     if final_state['plan_data']:
         logger.info("ACTION TAKEN: New plan was generated and saved to MongoDB.")
     else:
         logger.info("ACTION TAKEN: Plan maintained. No new plan generated.")
+
+# --- 4. Event Loop for Synchronous Callers ---
+# The module-level LLM keeps an async HTTP connection pool bound to the loop that first used it,
+# so every sync entry point runs on one long-lived loop instead of creating and closing a loop per run.
+
+_background_loop: Optional[asyncio.AbstractEventLoop] = None
+_background_loop_lock = threading.Lock()
+_STREAM_END = object()
+
+def _start_background_loop() -> asyncio.AbstractEventLoop:
+    """Starts a new event loop running forever in a daemon thread and returns it."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="agent-event-loop", daemon=True).start()
+    return loop
+
+def get_background_loop() -> asyncio.AbstractEventLoop:
+    """Returns the shared background event loop, starting it on first use."""
+    global _background_loop
+    if _background_loop is None:
+        with _background_loop_lock:
+            if _background_loop is None:
+                _background_loop = _start_background_loop()
+    return _background_loop
+
+async def _anext_or_end(states: AsyncIterator[Dict[str, Any]]) -> Any:
+    """Awaits the next item of an async iterator, returning _STREAM_END when it is exhausted."""
+    try:
+        return await states.__anext__()
+    except StopAsyncIteration:
+        return _STREAM_END
+
+async def run_agent_loop_async(user_id: str, app=None):
+    """Initializes and runs the LangGraph agent loop on the running event loop. Pass `app` to reuse a compiled graph."""
+    logger.info("\n\n--- Initializing LangGraph Agent Loop ---")
+    
+    app = app if app is not None else build_agent_graph()
+    
+    final_state = await app.ainvoke(_initial_state(user_id))
+    
+    _log_outcome(final_state)
     
     return final_state
 
-# --- Run the Agent (Main Entry Point) ---
+def run_agent_loop(user_id: str):
+    """Synchronous wrapper around run_agent_loop_async for callers without an event loop."""
+    return asyncio.run_coroutine_threadsafe(run_agent_loop_async(user_id), get_background_loop()).result()
+
+async def run_agent_loop_batch(user_ids: List[str], max_concurrency: int = 10) -> List[Dict[str, Any]]:
+    """
+    Runs the agent loop for several users concurrently, sharing one compiled graph.
+    At most `max_concurrency` runs are in flight at once, which also bounds concurrent
+    LLM requests. Final states are returned in the order of `user_ids`.
+    """
+    if max_concurrency < 1:
+        raise ValueError(f"max_concurrency must be at least 1, got {max_concurrency}.")
+    
+    app = build_agent_graph()
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def _run_one(user_id: str) -> Dict[str, Any]:
+        async with semaphore:
+            return await run_agent_loop_async(user_id, app=app)
+
+    return await asyncio.gather(*[_run_one(user_id) for user_id in user_ids])
+
+async def run_agent_loop_stream_async(user_id: str) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Runs the LangGraph agent loop, yielding the state as it evolves.
+    While the planning agent is generating, yielded states also carry a
+    'partial_plan' dict with the plan fields parsed so far, until the
+    agent's rationale is complete. The last state yielded is the final state.
+    """
+    logger.info("\n\n--- Initializing LangGraph Agent Loop (Streaming) ---")
+    
+    app = build_agent_graph()
+    
+    state: Dict[str, Any] = _initial_state(user_id)
+    plan_json = ""
+    rationale_done = False
+    
+    async for mode, payload in app.astream(state, stream_mode=["values", "messages"]):
+        if mode == "values":
+            state = payload
+            yield state
+            continue
+        
+        # LLM token chunk: with_structured_output(method="function_calling") forces a HealthPlan
+        # tool call, so the plan JSON arrives in the tool-call argument chunks
+        chunk, metadata = payload
+        if rationale_done or metadata.get("langgraph_node") != "planning_agent":
+            continue
+        
+        new_args = "".join(tool_chunk.get("args") or "" for tool_chunk in getattr(chunk, "tool_call_chunks", None) or [])
+        if not new_args:
+            continue
+        plan_json += new_args
+        
+        # Re-parsing the growing buffer is quadratic, so stop once the rationale (the only
+        # field streamed to the UI) is closed, i.e. a later field has started; the full plan
+        # arrives with the final state.
+        partial_plan = parse_partial_json(plan_json)
+        if isinstance(partial_plan, dict):
+            fields = list(partial_plan)
+            rationale_done = "agent_reasoning" in fields and fields[-1] != "agent_reasoning"
+            yield {**state, "partial_plan": partial_plan}
+    
+    _log_outcome(state)
+
+def run_agent_loop_stream(user_id: str) -> Iterator[Dict[str, Any]]:
+    """
+    Synchronous wrapper around run_agent_loop_stream_async for callers without an event loop (e.g. Streamlit).
+    The generator is driven on the shared background loop.
+    """
+    loop = get_background_loop()
+    states = run_agent_loop_stream_async(user_id)
+    try:
+        while True:
+            state = asyncio.run_coroutine_threadsafe(_anext_or_end(states), loop).result()
+            if state is _STREAM_END:
+                break
+            yield state
+    finally:
+        asyncio.run_coroutine_threadsafe(states.aclose(), loop).result()
+
+# --- 5. Run the Agent (Main Entry Point) ---
 if __name__ == "__main__":
     run_agent_loop(TEST_USER_ID)
\ No newline at end of file
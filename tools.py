@@ -1,17 +1,24 @@
 # tools.py - Core Functions for Data and Persistence (POLISHED & STABILIZED)
 
 import os
+import asyncio
+import threading
 import random
-import json
+import functools
+from types import MappingProxyType
 from dotenv import load_dotenv
 from pymongo.mongo_client import MongoClient
+from pymongo import UpdateMany, InsertOne
 from pymongo.server_api import ServerApi
-from typing import Optional, Dict, List, Any
+from typing import Optional, Dict, Any, Mapping
 from datetime import datetime, timedelta # <-- ADDED timedelta
+import numpy as np
 import pandas as pd
-from bson import json_util 
+from bson import ObjectId
 import logging 
 
+from models import HealthPlan
+
 # --- Logging Configuration ---
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO) 
@@ -25,28 +32,70 @@ load_dotenv()
 # --- 1. Database Connection & Helper ---
 
 _db_client: Optional[MongoClient] = None
+_db_client_lock = threading.Lock()
+
+def _ensure_indexes(client: MongoClient) -> None:
+    """Creates the indexes backing the hot plan queries. Idempotent; failures are logged, not raised."""
+    try:
+        # Partial index: only active plans are indexed, which is all the active-plan lookups ever match.
+        client["HealthCoachDB"]["plans"].create_index(
+            [("user_id", 1), ("is_active", 1)],
+            name="user_active_idx",
+            partialFilterExpression={"is_active": True}
+        )
+    except Exception as e:
+        logger.warning(f"Could not ensure indexes on 'plans' collection. Queries will still work, but unindexed. Error: {e}")
 
 def get_mongo_client() -> MongoClient:
-    """Initializes and returns the MongoDB client, connecting once, with error handling."""
+    """Initializes and returns the MongoDB client, connecting once (thread-safe), with error handling."""
     global _db_client
-    if _db_client is None:
+    if _db_client is not None:
+        return _db_client
+
+    # Concurrent first calls (e.g. batch runs in worker threads) must not each build their own client
+    with _db_client_lock:
+        if _db_client is not None:
+            return _db_client
+
         uri = os.getenv("MONGODB_URI")
         if not uri:
             logger.error("MONGODB_URI not found in environment variables. Cannot connect to database.")
             raise ValueError("MONGODB_URI not found in environment variables.")
         
+        client: Optional[MongoClient] = None
         try:
-            _db_client = MongoClient(uri, server_api=ServerApi('1'), serverSelectionTimeoutMS=5000) 
-            _db_client.admin.command('ping')
+            # Keep a small warm pool so later runs skip the TCP/TLS/auth handshake, and compress plan documents on the wire
+            client = MongoClient(
+                uri,
+                server_api=ServerApi('1'),
+                serverSelectionTimeoutMS=5000,
+                minPoolSize=2,
+                maxPoolSize=10,
+                maxIdleTimeMS=60000,
+                retryWrites=True,
+                compressors="zstd,zlib"
+            )
+            client.admin.command('ping')
             logger.info("Successfully connected to MongoDB!")
+            _ensure_indexes(client)
             
         except Exception as e:
             logger.error(f"Failed to connect to MongoDB. Check URI, network access, and credentials. Error: {e}")
-            _db_client = None
+            if client is not None:
+                client.close()
             raise ConnectionError("MongoDB connection failed.")
 
+        # Published only once connected, so other threads never see a half-initialized client
+        _db_client = client
+
     return _db_client
 
+def set_mongo_client(client: MongoClient) -> None:
+    """Registers an externally managed client (e.g. Streamlit's cached resource) as the shared connection."""
+    global _db_client
+    with _db_client_lock:
+        _db_client = client
+
 def get_collection(collection_name: str):
     """Returns the specified MongoDB collection for the agent's memory."""
     try:
@@ -64,31 +113,55 @@ def save_user_plan(user_id: str, plan_data: Dict[str, Any]) -> str:
     try:
         plans_collection = get_collection("plans")
         
+        plan_id = ObjectId() # Generated client-side so the ID is known without reading the write result
+        plan_data['_id'] = plan_id
         plan_data['user_id'] = user_id
         plan_data['created_at'] = datetime.now()
         plan_data['is_active'] = True
         
-        plans_collection.update_many(
-            {"user_id": user_id, "is_active": True},
-            {"$set": {"is_active": False}}
-        )
+        # Deactivate the previous plan and insert the new one in a single round-trip (ordered, so the update runs first)
+        plans_collection.bulk_write([
+            UpdateMany({"user_id": user_id, "is_active": True}, {"$set": {"is_active": False}}),
+            InsertOne(plan_data),
+        ], ordered=True)
 
-        result = plans_collection.insert_one(plan_data)
-        logger.info(f"New plan saved for user {user_id} with ID: {result.inserted_id}")
-        return f"Plan saved successfully with ID: {result.inserted_id}"
+        logger.info(f"New plan saved for user {user_id} with ID: {plan_id}")
+        return f"Plan saved successfully with ID: {plan_id}"
     except Exception as e:
         logger.error(f"Failed to save plan for user {user_id}. Error: {e}")
         return f"ERROR: Plan save failed. {e}"
 
 
+# The HealthPlan fields plus created_at, derived from the model so new plan fields are never dropped on load;
+# excluding _id avoids sending (and converting) the ObjectId.
+ACTIVE_PLAN_PROJECTION = {"_id": 0, "created_at": 1, **{field: 1 for field in HealthPlan.model_fields}}
+
+def _bson_to_py(value: Any) -> Any:
+    """Converts BSON-only types in a Mongo document to JSON-friendly values in a single in-place pass."""
+    if isinstance(value, dict):
+        for key, item in value.items():
+            value[key] = _bson_to_py(item)
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            value[index] = _bson_to_py(item)
+    elif isinstance(value, ObjectId):
+        return str(value)
+    elif isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
 def load_active_plan(user_id: str) -> Optional[Dict[str, Any]]:
     """Loads the current active health plan for the user, with error handling."""
     try:
         plans_collection = get_collection("plans")
-        plan_document = plans_collection.find_one({"user_id": user_id, "is_active": True})
+        plan_document = plans_collection.find_one(
+            {"user_id": user_id, "is_active": True},
+            projection=ACTIVE_PLAN_PROJECTION
+        )
         
         if plan_document:
-            clean_plan = json.loads(json_util.dumps(plan_document))
+            clean_plan = _bson_to_py(plan_document)
             logger.info(f"Active plan loaded for user {user_id}.")
             return clean_plan
         
@@ -103,17 +176,18 @@ def load_active_plan(user_id: str) -> Optional[Dict[str, Any]]:
 
 def get_daily_logs(user_id: str, date: str) -> Dict[str, Any]:
     """Mocks retrieving a user's daily health logs."""
-    random.seed(hash(user_id + date) % 1000)
+    # Local generator: deterministic per (user, date) and leaves the global random state untouched (thread-safe)
+    rng = random.Random(f"{user_id}:{date}")
     starting_weight = 85.0 
-    current_weight = round(starting_weight + random.uniform(-1.0, 1.0), 1)
+    current_weight = round(starting_weight + rng.uniform(-1.0, 1.0), 1)
 
     logs = {
         "user_id": user_id,
         "date": date,
         "weight_kg": current_weight,
-        "calories_consumed": random.randint(2000, 2600),
-        "activity_calories_burned": random.randint(400, 800),
-        "steps": random.randint(6000, 14000),
+        "calories_consumed": rng.randint(2000, 2600),
+        "activity_calories_burned": rng.randint(400, 800),
+        "steps": rng.randint(6000, 14000),
         "meals_summary": "Breakfast: Eggs & Avocado (400 kcal). Lunch: Chicken Rice (700 kcal). Dinner: Steak & Veggies (800 kcal). Snacks: 2 protein bars (500 kcal total)."
     }
     logger.debug(f"Mock logs generated for {user_id} on {date}.")
@@ -121,27 +195,31 @@ def get_daily_logs(user_id: str, date: str) -> Dict[str, Any]:
 
 # --- NEW: Synthetic History Tool for Visualization ---
 
-def generate_weight_history(user_id: str, initial_weight: float, weeks: int = 12) -> List[Dict[str, Any]]:
+def generate_weight_history(user_id: str, initial_weight: float, weeks: int = 12, rng: Optional[np.random.Generator] = None) -> pd.DataFrame:
     """
     Generates synthetic weekly weight history for visualization purposes.
+    Pass `rng` for reproducible data; otherwise a fresh generator is used.
     """
-    history = []
+    rng = rng if rng is not None else np.random.default_rng()
     # Target loss of 0.5kg per week for a moderate goal
     target_weekly_loss = 0.5 
     
-    for i in range(weeks):
-        ideal_weight = initial_weight - (target_weekly_loss * (i + 1))
-        
-        # Simulate actual weight fluctuating slightly around the ideal trend
-        fluctuation = random.uniform(-0.4, 0.4) * (1 + i * 0.1) 
-        actual_weight = ideal_weight + fluctuation
-        
-        history.append({
-            "week": i + 1,
-            "date": (datetime.now() - timedelta(weeks=weeks-i)).strftime("%Y-%m-%d"),
-            "actual_weight_kg": round(actual_weight, 2),
-            "target_trend_kg": round(ideal_weight, 2),
-        })
+    week_numbers = np.arange(1, weeks + 1)
+    ideal_weight = initial_weight - (target_weekly_loss * week_numbers)
+    
+    # Simulate actual weight fluctuating slightly around the ideal trend (wider as weeks go by)
+    fluctuation = rng.uniform(-0.4, 0.4, size=weeks) * (1 + (week_numbers - 1) * 0.1)
+    actual_weight = ideal_weight + fluctuation
+    
+    # One entry per week, the latest one a week ago
+    dates = pd.date_range(end=datetime.now() - timedelta(weeks=1), periods=weeks, freq="7D").strftime("%Y-%m-%d")
+    
+    history = pd.DataFrame({
+        "week": week_numbers,
+        "date": dates,
+        "actual_weight_kg": actual_weight.round(2),
+        "target_trend_kg": ideal_weight.round(2),
+    })
         
     logger.debug(f"Generated {weeks} weeks of synthetic history for user {user_id}.")
     return history
@@ -151,23 +229,24 @@ def generate_weight_history(user_id: str, initial_weight: float, weeks: int = 12
 
 MALE_ADJUST = 5
 FEMALE_ADJUST = -161
+GENDER_ADJUSTMENTS = {"male": MALE_ADJUST, "female": FEMALE_ADJUST} # Unknown genders get no adjustment
 ACTIVITY_FACTORS = {
     "sedentary": 1.2, "lightly active": 1.375, "moderately active": 1.55, "very active": 1.725,
 }
 
 def calculate_metrics(weight_kg: float, height_cm: float, age_years: int, gender: str, activity_level: str = "moderately active") -> Dict[str, float]:
     """Calculates BMR and TDEE with input validation and error handling."""
-    
+    # The computation is memoized; each caller gets its own plain-dict copy of the cached result.
+    return dict(_calculate_metrics_cached(weight_kg, height_cm, age_years, gender, activity_level))
+
+@functools.lru_cache(maxsize=256)
+def _calculate_metrics_cached(weight_kg: float, height_cm: float, age_years: int, gender: str, activity_level: str) -> Mapping[str, float]:
+    """Pure BMR/TDEE computation behind calculate_metrics, cached per input and returned read-only."""
     try:
         if not all(isinstance(x, (int, float)) and x > 0 for x in [weight_kg, height_cm, age_years]):
              raise ValueError("Weight, height, and age must be positive numbers.")
 
-        bmr = (10 * weight_kg) + (6.25 * height_cm) - (5 * age_years)
-        
-        if gender.lower() == 'male':
-            bmr += MALE_ADJUST
-        elif gender.lower() == 'female':
-            bmr += FEMALE_ADJUST
+        bmr = (10 * weight_kg) + (6.25 * height_cm) - (5 * age_years) + GENDER_ADJUSTMENTS.get(gender.lower(), 0)
         
         factor = ACTIVITY_FACTORS.get(activity_level.lower(), 1.55)
         tdee = bmr * factor
@@ -178,12 +257,12 @@ def calculate_metrics(weight_kg: float, height_cm: float, age_years: int, gender
 
         logger.debug(f"Metrics calculated: TDEE={target_maintain} kcal.")
         
-        return {
+        return MappingProxyType({
             "bmr_kcal": target_maintain - target_deficit,
             "tdee_kcal": target_maintain,
             "target_weight_loss_kcal": target_lose,
             "activity_factor_used": factor
-        }
+        })
         
     except ValueError as ve:
         logger.error(f"Validation error in calculate_metrics: {ve}")
@@ -191,3 +270,28 @@ def calculate_metrics(weight_kg: float, height_cm: float, age_years: int, gender
     except Exception as e:
         logger.error(f"Unexpected error during metric calculation: {e}")
         raise
+
+
+# --- 5. Async Tool Variants (Non-Blocking for Async Chains/Graphs) ---
+# pymongo and the calculation helpers are synchronous. These coroutine variants run them
+# in a worker thread so callers on the event loop are never blocked by database I/O.
+
+async def _to_async(fn, *args, **kwargs):
+    """Runs a blocking function in the default thread pool and awaits its result."""
+    return await asyncio.to_thread(fn, *args, **kwargs)
+
+async def save_user_plan_async(user_id: str, plan_data: Dict[str, Any]) -> str:
+    """Async variant of save_user_plan."""
+    return await _to_async(save_user_plan, user_id, plan_data)
+
+async def load_active_plan_async(user_id: str) -> Optional[Dict[str, Any]]:
+    """Async variant of load_active_plan."""
+    return await _to_async(load_active_plan, user_id)
+
+async def get_daily_logs_async(user_id: str, date: str) -> Dict[str, Any]:
+    """Async variant of get_daily_logs."""
+    return await _to_async(get_daily_logs, user_id, date)
+
+async def calculate_metrics_async(weight_kg: float, height_cm: float, age_years: int, gender: str, activity_level: str = "moderately active") -> Dict[str, float]:
+    """Async variant of calculate_metrics."""
+    return await _to_async(calculate_metrics, weight_kg, height_cm, age_years, gender, activity_level)